@@ -1,22 +1,37 @@
 import os
-import xarray as xr
-import matplotlib.pyplot as plt
+import math
+import matplotlib
 import matplotlib.colors as mcolors
 import numpy as np
 import time
 import gc
 import psutil
 import json
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-from multiprocessing import Pool, cpu_count
-from datetime import datetime
+import eccodes
+from PIL import Image, ImageDraw, ImageFont
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from numba import njit, prange, set_num_threads, config as numba_config
+except ImportError:
+    njit = None
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None  # Not installed (or not Linux): the service polls instead
 
 # Processing settings
-CLEANUP_GRIB = False
 REPROCESS = False     
 MAX_WORKERS = max(1, cpu_count() - 1)  # Use all but one core
 MIN_FREE_RAM_GB = 0.5 
+RAM_CHECK_TTL_S = 2.0  # ram_ok() reuses its last reading for this long
+GC_EVERY_N_FILES = 50  # Full cyclic GC once per this many files per worker
+POLL_INTERVAL_S = 60   # Scan interval when inotify is unavailable
+HEARTBEAT_S = 300      # Full rescan interval with inotify, for anything the events missed
+EVENT_BATCH_S = 2      # Arrivals within this window are dispatched together
 
 # Region Definitions (Strict Lat/Lon Boxes)
 REGIONS = {
@@ -39,233 +54,560 @@ PRESSURE_LEVELS = np.arange(960, 1060, 4)
 WIND_COLORS = ['#FFFFFF', '#E0E0E0', '#B0C4DE', '#87CEFA', '#00BFFF', '#1E90FF', '#0000FF', '#8A2BE2', '#DA70D6', '#FF00FF', '#FF1493', '#8B0000', '#4B0000']
 WIND_LEVELS = [0, 5, 10, 15, 20, 25, 30, 40, 50, 60, 80, 100]
 
+# Unit conversions work in place on the decoded float32 fields
+def kelvin_to_f(x):
+    # Same operation order as (x - 273.15) * 9/5 + 32
+    x -= 273.15
+    x *= 9
+    x /= 5
+    x += 32
+    return x
+
 VAR_CONFIG = {
     't2m': {
         'cmap': mcolors.LinearSegmentedColormap.from_list('nws_temp', NWS_TEMP_COLORS),
         'levels': np.arange(-40, 121, 2), 
-        'unit_conv': lambda x: (x - 273.15) * 9/5 + 32, 'unit_label': '°F',
-        'key': 't2m', 
-        'filter': {'typeOfLevel': 'heightAboveGround', 'level': 2}
+        'unit_conv': kelvin_to_f, 'unit_label': '°F',
+        'key': 't2m'
     },
     'tp': {
         'cmap': mcolors.ListedColormap(NWS_PRECIP_COLORS),
         'levels': NWS_PRECIP_LEVELS,
-        'unit_conv': lambda x: x / 25.4, 'unit_label': 'in',
-        'key': 'tp',
-        'filter': {'shortName': 'tp'}
+        'unit_conv': lambda x: np.divide(x, 25.4, out=x), 'unit_label': 'in',
+        'key': 'tp'
     },
     'prmsl': {
         'cmap': mcolors.LinearSegmentedColormap.from_list('nws_pres', NWS_PRESSURE_COLORS),
         'levels': PRESSURE_LEVELS,
-        'unit_conv': lambda x: x / 100.0, 'unit_label': 'hPa',
-        'key': 'prmsl',
-        'filter': {'shortName': 'prmsl'}
+        'unit_conv': lambda x: np.divide(x, 100.0, out=x), 'unit_label': 'hPa',
+        'key': 'prmsl'
     },
     'wind_speed': {
         'cmap': mcolors.ListedColormap(WIND_COLORS), 
         'levels': WIND_LEVELS, 
-        'unit_conv': lambda x: x * 2.23694, 'unit_label': 'mph',
-        'key': 'wind_speed', 
-        'filter': {'typeOfLevel': 'heightAboveGround', 'level': 10} 
+        'unit_conv': lambda x: np.multiply(x, 2.23694, out=x), 'unit_label': 'mph',
+        'key': 'wind_speed'
     }
 }
 
-def process_file(file_path):
+# Raster output settings (Web Mercator, same frame Leaflet overlays on)
+MAP_WIDTH_PX = 1000
+EARTH_RADIUS_M = 6378137.0
+LAYER_ALPHA = 0.7      # Global transparency for every layer except precip
+TP_MASK_BELOW = 0.01   # Precip below this (inches) is fully transparent
+PNG_COMPRESS_LEVEL = 1 # zlib level: ~3-5x faster encode than the default 6 for ~10% larger files
+PNG_WRITE_THREADS = 4  # Per worker: one per variable, so a region's PNGs encode concurrently
+
+# Legend strip layout (px)
+LEGEND_WIDTH = 500
+LEGEND_BAR_HEIGHT = 24
+LEGEND_FONT_SIZE = 12
+
+# Per-pixel render: bilinear sample -> level bin, in one pass over the output for every field
+# of a region at once (they share the source grid, so the indices/weights are loaded once per pixel).
+# Bin k means levels[f, k-1] <= v < levels[f, k]; NaN gets its own (transparent) bin at nlevels[f] + 1
+# so the palette needs no mask. The bins are the palette indices of the PNG-8s that get written.
+if njit is not None:
+    # Full fastmath would assume no NaNs and drop the v != v check
+    @njit(parallel=True, nogil=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})
+    def render_bins(srcs, iy, fy, ix, fx, levels, nlevels, out):
+        for r in prange(iy.size):
+            i, wy = iy[r], fy[r]
+            for c in range(ix.size):
+                j, wx = ix[c], fx[c]
+                for f in range(len(srcs)):
+                    src = srcs[f]
+                    top = src[i, j] * (1 - wx) + src[i, j + 1] * wx
+                    bottom = src[i + 1, j] * (1 - wx) + src[i + 1, j + 1] * wx
+                    v = top * (1 - wy) + bottom * wy
+                    if v != v:
+                        out[f, r, c] = nlevels[f] + 1
+                    else:
+                        # Binary search for the first level > v (searchsorted side='right')
+                        lo, hi = 0, nlevels[f]
+                        while lo < hi:
+                            mid = (lo + hi) >> 1
+                            if v >= levels[f, mid]:
+                                lo = mid + 1
+                            else:
+                                hi = mid
+                        out[f, r, c] = lo
+else:
+    def render_bins(srcs, iy, fy, ix, fx, levels, nlevels, out):
+        for f, src in enumerate(srcs):
+            field = bilinear(src, (iy[:, None], fy[:, None], ix[None, :], fx[None, :]))
+            out[f] = np.searchsorted(levels[f, :nlevels[f]], field, side='right')
+            out[f][np.isnan(field)] = nlevels[f] + 1
+
+# Wind speed from the u/v components in one float32 pass, written into out (may be u itself)
+if njit is not None:
+    @njit(parallel=True, nogil=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})
+    def wind_speed(u, v, out):
+        for i in prange(u.shape[0]):
+            for j in range(u.shape[1]):
+                out[i, j] = math.sqrt(u[i, j] * u[i, j] + v[i, j] * v[i, j])
+else:
+    def wind_speed(u, v, out):
+        np.hypot(u, v, out=out)
+
+# Bin buffers are reused for every region of the same size rendered by this worker
+_BIN_BUFFERS = {}
+
+def _bin_buffer(fields, height, width):
+    buf = _BIN_BUFFERS.get((fields, height, width))
+    if buf is None:
+        buf = _BIN_BUFFERS[(fields, height, width)] = np.empty((fields, height, width), dtype=np.uint8)
+    return buf
+
+def build_palette(var_key, config):
+    """
+    Returns the uint8 RGBA LUT for a variable, one row per render_bins() level bin.
+    Colors come from the same cmap + BoundaryNorm the legends use.
+    """
+    levels = np.asarray(config['levels'], dtype=np.float64)
+    cmap = config['cmap']
+    if isinstance(cmap, str): cmap = matplotlib.colormaps[cmap]
+    norm = mcolors.BoundaryNorm(levels, ncolors=cmap.N, extend='both')
+
+    # One representative value per bin: below range, each interval midpoint, above range
+    reps = np.concatenate(([levels[0] - 1], (levels[:-1] + levels[1:]) / 2, [levels[-1] + 1]))
+    palette = np.zeros((len(levels) + 2, 4), dtype=np.uint8)
+    palette[:-1] = cmap(norm(reps), bytes=True)
+
+    if var_key == 'tp':
+        palette[:-1][reps < TP_MASK_BELOW, 3] = 0
+    else:
+        palette[:-1, 3] = int(LAYER_ALPHA * 255)
+    palette[palette[:, 3] == 0] = 0
+    return palette
+
+# Output frames, crops and bilinear weights are fixed per region (and source grid): build once per worker
+_FRAMES = {}
+_INTERP_CACHE = {}
+
+def region_frame(reg_name):
+    """
+    Pixel-center lat/lon of the Web Mercator output image for a region.
+    Width is fixed, height follows the projected aspect ratio.
+    """
+    if reg_name in _FRAMES:
+        return _FRAMES[reg_name]
+
+    lon_min, lon_max, lat_min, lat_max = REGIONS[reg_name]['extent']
+    merc_y = lambda lat: EARTH_RADIUS_M * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+    x0, x1 = EARTH_RADIUS_M * math.radians(lon_min), EARTH_RADIUS_M * math.radians(lon_max)
+    y0, y1 = merc_y(lat_min), merc_y(lat_max)
+
+    width = MAP_WIDTH_PX
+    height = int(width * (y1 - y0) / (x1 - x0))
+
+    xs = x0 + (np.arange(width) + 0.5) * (x1 - x0) / width
+    ys = y1 - (np.arange(height) + 0.5) * (y1 - y0) / height  # Row 0 is the north edge
+    lons = np.degrees(xs / EARTH_RADIUS_M)
+    lats = np.degrees(2 * np.arctan(np.exp(ys / EARTH_RADIUS_M)) - math.pi / 2)
+    _FRAMES[reg_name] = (lats, lons)
+    return lats, lons
+
+def _axis_weights(src, tgt):
+    # Lower neighbour and fractional offset per target (src ascending).
+    # Fractions outside [0, 1] extrapolate the sub-cell sliver past the last column (global east edge).
+    i0 = np.clip(np.searchsorted(src, tgt) - 1, 0, len(src) - 2)
+    frac = (tgt - src[i0]) / (src[i0 + 1] - src[i0])
+    return i0, frac
+
+def crop_slices(lat, lon, extent, pad=2):
+    """Row/column slices of the (ascending) grid covering a region extent plus pad degrees."""
+    # REGIONS all sit inside -180/180, so a crop never wraps the antimeridian
+    lon_min, lon_max, lat_min, lat_max = extent
+    rows = slice(int(np.searchsorted(lat, lat_min - pad)), int(np.searchsorted(lat, lat_max + pad, side='right')))
+    cols = slice(int(np.searchsorted(lon, lon_min - pad)), int(np.searchsorted(lon, lon_max + pad, side='right')))
+    return rows, cols
+
+def region_grid(reg_name, src_lat, src_lon):
+    """
+    Index-space crop of a source lat/lon grid for a region, plus the bilinear indices/weights
+    from that crop to the region frame (None if the crop is too small to interpolate).
+    The grid is rectilinear so the weights are separable: per-row and per-column (index, fraction).
+    """
+    key = (reg_name, hash(src_lat.tobytes()), hash(src_lon.tobytes()))
+    cached = _INTERP_CACHE.get(key)
+    if cached is None:
+        rows, cols = crop_slices(src_lat, src_lon, REGIONS[reg_name]['extent'])
+        crop_lat, crop_lon = src_lat[rows], src_lon[cols]
+        weights = None
+        if crop_lat.size >= 2 and crop_lon.size >= 2:
+            tgt_lat, tgt_lon = region_frame(reg_name)
+            iy, fy = _axis_weights(crop_lat, tgt_lat)
+            ix, fx = _axis_weights(crop_lon, tgt_lon)
+            # float32 fractions keep the whole per-pixel lerp in float32, like the fields
+            weights = (iy, fy.astype(np.float32), ix, fx.astype(np.float32))
+        cached = _INTERP_CACHE[key] = (rows, cols, weights)
+    return cached
+
+def bilinear(values, weights):
+    # NumPy path; weights broadcast as (rows, 1) and (1, cols)
+    iy, fy, ix, fx = weights
+    top = values[iy, ix] * (1 - fx) + values[iy, ix + 1] * fx
+    bottom = values[iy + 1, ix] * (1 - fx) + values[iy + 1, ix + 1] * fx
+    return top * (1 - fy) + bottom * fy
+
+def atomic_write(out_path, write):
+    """
+    Calls write(tmp_path) beside the target, then renames it over out_path: readers (Flask, the
+    next cycle's existence check) see the old file or the new one, never a partial write.
+    No fsync: every output can be regenerated from its GRIB.
+    """
+    tmp_path = f"{out_path}.tmp.{os.getpid()}"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+def write_png(bins, png_palette, out_path):
+    """Writes one layer of level bins as a palette PNG."""
+    rgb, alpha = png_palette
+    # Map the reused bin buffer directly (no copy); it is only read until save() returns
+    img = Image.frombuffer('P', (bins.shape[1], bins.shape[0]), bins, 'raw', 'P', 0, 1)
+    img.putpalette(rgb)
+    atomic_write(out_path, lambda tmp_path: img.save(tmp_path, 'PNG', transparency=alpha,
+                                                     compress_level=PNG_COMPRESS_LEVEL, optimize=False))
+
+def write_stats(stats, json_path):
+    def dump(tmp_path):
+        with open(tmp_path, 'w') as jf:
+            json.dump(stats, jf)
+    atomic_write(json_path, dump)
+
+_LEVEL_TABLES = {}
+_png_pool = None  # Created lazily in each worker process (threads do not survive fork)
+
+def stacked_levels(var_keys):
+    """Levels of several variables as one +inf-padded (fields, max levels) table plus per-row counts."""
+    key = tuple(var_keys)
+    if key not in _LEVEL_TABLES:
+        rows = [VAR_CONFIG[k]['levels_arr'] for k in key]
+        table = np.full((len(rows), max(r.size for r in rows)), np.inf, dtype=np.float32)
+        for f, r in enumerate(rows):
+            table[f, :r.size] = r
+        _LEVEL_TABLES[key] = (table, np.array([r.size for r in rows], dtype=np.intp))
+    return _LEVEL_TABLES[key]
+
+def render_region(fields, weights, var_keys, out_paths):
+    """
+    Bilinearly resamples every field of one region onto its frame in a single kernel pass,
+    bins each with its variable's levels and writes one palette PNG per field.
+    """
+    global _png_pool
+    iy, fy, ix, fx = weights
+    levels, nlevels = stacked_levels(var_keys)
+    bins = _bin_buffer(len(fields), iy.size, ix.size)
+    render_bins(tuple(fields), iy, fy, ix, fx, levels, nlevels, bins)
+
+    # The kernel is already parallel over rows, on every core when this is the only file in
+    # flight (see kernel_threads); the serial part left is zlib, which PIL runs without the GIL.
+    # All writes finish before returning, as the next region reuses the buffer.
+    if _png_pool is None:
+        _png_pool = ThreadPoolExecutor(max_workers=PNG_WRITE_THREADS)
+    palettes = [VAR_CONFIG[k]['png_palette'] for k in var_keys]
+    list(_png_pool.map(write_png, bins, palettes, out_paths))
+
+def field_stats(values, unit_label):
+    """Min/max of a (converted) crop for the map's JSON sidecar."""
+    # fmin/fmax skip NaNs in one pass with no mask or compacted copy
+    # (what np.nanmin does internally, minus its all-NaN warning)
+    min_val, max_val = float(np.fmin.reduce(values, axis=None)), float(np.fmax.reduce(values, axis=None))
+    if math.isnan(min_val):
+        min_val, max_val = 0.0, 0.0
+    return {'min': min_val, 'max': max_val, 'unit': unit_label}
+
+# Colormaps are fixed, so quantize each one to its uint8 LUT once at import.
+# Maps and legends both read these instead of evaluating cmap(norm(...)).
+for _var_key, _config in VAR_CONFIG.items():
+    _config['levels_arr'] = np.asarray(_config['levels'], dtype=np.float32)
+    _config['palette_u8'] = build_palette(_var_key, _config)
+    # PLTE / tRNS chunk payloads
+    _config['png_palette'] = (_config['palette_u8'][:, :3].tobytes(), _config['palette_u8'][:, 3].tobytes())
+
+
+# Fields pulled from every GRIB: eccodes shortName -> processor name
+GRIB_VARS = {'2t': 't2m', 'tp': 'tp', 'prmsl': 'prmsl', '10u': 'u10', '10v': 'v10'}
+
+def standardize_grid(lat, lon):
+    """
+    Puts a grid on -180/180 longitudes with both axes ascending.
+    GFS is 0-360 and north-to-south. Standardizing keeps cropping and the map frame simple.
+    Returns the standardized (lat, lon) and reorder(field), which moves a field onto them.
+    """
+    dlon = lon[1] - lon[0] if lon.size > 1 else 0.0
+    if lon[0] >= 0 and dlon > 0 and np.allclose(np.diff(lon), dlon):
+        # Regular 0-360 grid: the wrap is a single roll at 180 and latitude at most needs a flip,
+        # instead of a full 2-D sort
+        flip = lat[0] > lat[-1]
+        if flip: lat = np.ascontiguousarray(lat[::-1])
+        shift = -int(np.searchsorted(lon, 180))
+        lon = np.roll(((lon + 180) % 360) - 180, shift)
+        return lat, lon, lambda v: np.roll(v[::-1] if flip else v, shift, axis=-1)
+
+    lon = ((lon + 180) % 360) - 180
+    lat_order, lon_order = np.argsort(lat, kind='stable'), np.argsort(lon, kind='stable')
+    return lat[lat_order], lon[lon_order], lambda v: v[lat_order][:, lon_order]
+
+# Standardized grids keyed by the md5 of the GRIB grid section; every AIGFS file has the same one
+_GRIDS = {}
+
+def source_grid(h):
+    """
+    Standardized lat/lon axes and field reorder for a message's grid (see standardize_grid).
+    eccodes computes distinctLatitudes/distinctLongitudes by walking every grid point, and the
+    wrap/sort is the same for every file on a grid, so both are worked out once per grid.
+    """
+    key = eccodes.codes_get(h, 'md5GridSection')
+    if key not in _GRIDS:
+        grid_type = eccodes.codes_get(h, 'gridType')
+        if grid_type != 'regular_ll':
+            raise ValueError(f"Unsupported grid type {grid_type} in GRIB file")
+        _GRIDS[key] = standardize_grid(eccodes.codes_get_array(h, 'distinctLatitudes'),
+                                       eccodes.codes_get_array(h, 'distinctLongitudes'))
+    return _GRIDS[key]
+
+def load_grib(file_path):
+    """
+    Decodes GRIB_VARS straight from the GRIB messages with eccodes (no index, no xarray).
+    Returns ({name: float32 field}, lat, lon) on the standardized grid.
+    Raises on any eccodes error or missing variable so the caller can treat the file as corrupt.
+    """
+    fields, grid = {}, None
+    with open(file_path, 'rb') as f:
+        while len(fields) < len(GRIB_VARS):
+            h = eccodes.codes_grib_new_from_file(f)
+            if h is None: break
+            try:
+                var = GRIB_VARS.get(eccodes.codes_get(h, 'shortName'))
+                if var is None or var in fields: continue
+                if grid is None:
+                    # Every AIGFS message shares one grid, so it comes from the first one read
+                    grid = source_grid(h)
+                lat, lon, reorder = grid
+                # Decoded straight to float32: plenty for binning, and half the traffic of every later pass
+                values = eccodes.codes_get_float_array(h, 'values')
+                values[values == np.float32(eccodes.codes_get_double(h, 'missingValue'))] = np.nan
+                # reshape raises if a message is not on the shared grid
+                fields[var] = reorder(values.reshape(lat.size, lon.size))
+            finally:
+                eccodes.codes_release(h)
+
+    missing = [v for v in GRIB_VARS.values() if v not in fields]
+    if missing:
+        # The file is effectively empty/useless/corrupt for these variables
+        raise ValueError(f"No data variables found in GRIB file for {missing} (possible corruption or empty)")
+    return fields, lat, lon
+
+def parse_grib_name(file_path):
+    # data/{date}_{run}/aigfs.t{run}z.sfc.f{fhr}.grib2
+    basename = os.path.basename(file_path)
+    parts = basename.split('.')
+    return {
+        'basename': basename,
+        'run': parts[1][1:3],
+        'fhr_str': parts[3][1:],
+        'fhr': int(parts[3][1:]),
+        'date_str': os.path.basename(os.path.dirname(file_path)).split('_')[0],
+    }
+
+def build_tasks(meta, existing):
+    """
+    Returns the (region, var, png filename) maps still missing for one GRIB.
+    existing is the set of filenames already in the output directory.
+    """
+    tasks = []
+    for reg_name, reg_cfg in REGIONS.items():
+        if meta['fhr'] > reg_cfg['max_fhr']: continue
+        prefix = f"aigfs_{reg_name}_{meta['date_str']}_{meta['run']}_{meta['fhr_str']}_"
+        for var_key in VAR_CONFIG:
+            out_filename = f"{prefix}{var_key}.png"
+            if REPROCESS or out_filename not in existing:
+                tasks.append((reg_name, var_key, out_filename))
+    return tasks
+
+def existing_outputs(output_dir):
+    """Map filenames in output_dir, listed once so task checks are set lookups instead of stats."""
+    # Maps are renamed into place complete, so a listed PNG is never a zero-byte partial write
+    with os.scandir(output_dir) as entries:
+        return {de.name for de in entries if de.name.endswith('.png')}
+
+PNG_TRAILER = b'\x00\x00\x00\x00IEND\xaeB`\x82'  # Last 12 bytes of every complete PNG
+
+def remove_partial_maps(output_dir):
+    """
+    Deletes zero-byte or truncated PNGs so they are rendered again. Maps written since the atomic
+    rename cannot be partial, but ones left by the old in-place writer can; run once at startup.
+    Returns the number removed.
+    """
+    removed = 0
+    with os.scandir(output_dir) as entries:
+        for de in entries:
+            if not de.name.endswith('.png'):
+                continue
+            try:
+                size = de.stat().st_size
+                if size >= len(PNG_TRAILER):
+                    with open(de.path, 'rb') as f:
+                        f.seek(-len(PNG_TRAILER), os.SEEK_END)
+                        if f.read() == PNG_TRAILER:
+                            continue
+                os.remove(de.path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+def scan_data_dir(data_dir):
+    """
+    One scandir pass over the data tree per cycle.
+    Returns the GRIB paths (sorted within each run directory) and any orphaned cfgrib .idx files,
+    i.e. indexes whose GRIB is gone. Indexes of GRIBs still on disk are left alone: other readers
+    (ml_collector.py) open the files through cfgrib and reuse them.
+    """
+    gribs, indexes = [], []
+    stack = [data_dir] if os.path.isdir(data_dir) else []
+    while stack:
+        root = stack.pop()
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda de: de.name)
+        subdirs, names = [], {de.name for de in entries}
+        for de in entries:
+            if de.is_dir(follow_symlinks=False):
+                subdirs.append(de.path)
+            elif de.name.endswith('.grib2'):
+                gribs.append(de.path)
+            elif de.name.endswith('.idx') and '.grib2.' in de.name:
+                # cfgrib names them {grib}.{hash}.idx
+                if de.name.split('.grib2.', 1)[0] + '.grib2' not in names:
+                    indexes.append(de.path)
+        # Visit subdirectories in name order, after the current directory (like os.walk)
+        stack.extend(reversed(subdirs))
+    return gribs, indexes
+
+_files_since_gc = 0
+_last_mem_check = [0.0, True]  # [monotonic time, ok]
+
+def ram_ok():
+    """Free-RAM gate, re-read from psutil at most once per RAM_CHECK_TTL_S."""
+    now = time.monotonic()
+    if now - _last_mem_check[0] >= RAM_CHECK_TTL_S:
+        _last_mem_check[:] = [now, psutil.virtual_memory().available >= MIN_FREE_RAM_GB * 1024**3]
+    return _last_mem_check[1]
+
+def pending_jobs(grib_paths, existing):
+    """
+    Pairs each GRIB with its missing maps, dropping files that are fully rendered,
+    so workers only ever receive files with work to do.
+    """
+    jobs = []
+    for path in grib_paths:
+        try:
+            tasks = build_tasks(parse_grib_name(path), existing)
+        except (IndexError, ValueError):
+            tasks = None  # Unexpected filename: let the worker's error handling deal with it
+        if tasks is None or tasks:
+            jobs.append((path, tasks))
+    return jobs
+
+def kernel_threads(in_flight):
+    """Numba threads per file when `in_flight` files are being rendered at once."""
+    share = max(1, cpu_count() // max(1, min(MAX_WORKERS, in_flight)))
+    # set_num_threads() rejects anything above Numba's pool size, which NUMBA_NUM_THREADS or
+    # the CPU affinity mask can put below cpu_count()
+    return min(share, numba_config.NUMBA_NUM_THREADS) if njit is not None else share
+
+def process_file(file_path, tasks=None, threads=None):
+    # Callers that dispatch several files at once pass each file's share of the cores, so a
+    # lone file gets every core for its kernels and a full pool does not oversubscribe them
+    if threads is not None and njit is not None:
+        set_num_threads(threads)
+    # Map buffers are numpy arrays freed by refcounting, so cyclic GC passes only add stalls
+    # while a file is in flight. Collect occasionally instead to catch any long-lived growth.
+    global _files_since_gc
+    gc.disable()
+    try:
+        return _process_file(file_path, tasks)
+    finally:
+        gc.enable()
+        _files_since_gc += 1
+        if _files_since_gc >= GC_EVERY_N_FILES:
+            gc.collect()
+            _files_since_gc = 0
+
+def _process_file(file_path, tasks):
     try:
         # Check memory
-        mem = psutil.virtual_memory()
-        if mem.available < (MIN_FREE_RAM_GB * 1024**3): 
+        if not ram_ok():
             print("Skipping due to low RAM")
             return False
 
-        basename = os.path.basename(file_path)
-        parts = basename.split('.')
-        run = parts[1][1:3]
-        fhr_str = parts[3][1:]
-        fhr_int = int(fhr_str)
-        date_str = os.path.basename(os.path.dirname(file_path)).split('_')[0]
+        meta = parse_grib_name(file_path)
+        basename, date_str, run = meta['basename'], meta['date_str'], meta['run']
         output_dir = os.path.join("static", "maps")
-        
-        # Determine needed tasks
-        tasks_needed = False
-        for reg_name, reg_cfg in REGIONS.items():
-            if fhr_int > reg_cfg['max_fhr']: continue
-            for var_key in VAR_CONFIG.keys():
-                out_filename = f"aigfs_{reg_name}_{date_str}_{run}_{fhr_str}_{var_key}.png"
-                out_path = os.path.join(output_dir, out_filename)
-                
-                # IMPORTANT: If file doesn't exist, we need to process.
-                if REPROCESS or not os.path.exists(out_path):
-                    tasks_needed = True
-                    break
-                
-                # EXTRA CHECK: If file exists but is empty (0 bytes), it's corrupted -> reprocessing needed
-                if os.path.exists(out_path) and os.path.getsize(out_path) == 0:
-                    try: os.remove(out_path)
-                    except: pass
-                    tasks_needed = True
-                    break
-            
-            if tasks_needed: break
-        
-        if not tasks_needed:
+
+        # Determine needed tasks (the service passes them in; direct callers get them computed here)
+        if tasks is None:
+            tasks = build_tasks(meta, existing_outputs(output_dir))
+        if not tasks:
              # print(f"Skipping {basename} - All maps already exist") 
              return True
 
         print(f"Processing {basename} (Date: {date_str}, Run: {run}Z)...")
         
-        # 1. Load Data
-        data_cache = {}
-        
-        # Track bad file attempts
-        bad_file = False
-
-        def load_var(filter_keys, internal_name):
-            nonlocal bad_file
-            if bad_file: return 
-
-            try:
-                # Disable on-disk indexing to prevent "Ignoring index file" errors and log spam
-                # This forces in-memory indexing which is safer when files might be updated
-                # errors='raise' forces cfgrib to throw an exception on corruption instead of just logging "skipping..."
-                ds = xr.open_dataset(file_path, engine='cfgrib', 
-                                    cache=False,
-                                    backend_kwargs={'filter_by_keys': filter_keys, 'indexpath': '', 'errors': 'raise'})
-                
-                if not ds.data_vars:
-                    # If no variables found, the file is effectively empty/useless/corrupt for this filter
-                    ds.close()
-                    raise ValueError("No data variables found in GRIB file (possible corruption or empty)")
-
-                var = list(ds.data_vars)[0]
-                val = ds[var]
-                # Fix Longitude: GFS is 0-360. Cartopy handles this, BUT standardizing to -180/180 is safer for cropping.
-                val = val.assign_coords(longitude=(((val.longitude + 180) % 360) - 180)).sortby(['latitude', 'longitude'])
-                data_cache[internal_name] = val
-                ds.close()
-            except BaseException as e:
-                # Catch ANY exception from cfgrib/xarray during load (including BaseException for library errors)
-                if isinstance(e, (KeyboardInterrupt, SystemExit)):
-                    raise e
-                
-                bad_file = True
-                raise e 
-
-        try:
-            load_var(VAR_CONFIG['t2m']['filter'], 't2m')
-            load_var(VAR_CONFIG['tp']['filter'], 'tp')
-            load_var(VAR_CONFIG['prmsl']['filter'], 'prmsl')
-            load_var({'typeOfLevel': 'heightAboveGround', 'level': 10, 'shortName': 'u10'}, 'u10')
-            load_var({'typeOfLevel': 'heightAboveGround', 'level': 10, 'shortName': 'v10'}, 'v10')
-        except BaseException as e:
-             # If bad_file was flagged, re-raise to hit the delete logic
-             if isinstance(e, (KeyboardInterrupt, SystemExit)): raise e
-             if bad_file: raise e
+        # 1. Load Data (any failure here falls through to the corrupted-file cleanup below)
+        data_cache, lat, lon = load_grib(file_path)
 
         if 'u10' in data_cache and 'v10' in data_cache:
-            data_cache['wind_speed'] = np.sqrt(data_cache['u10']**2 + data_cache['v10']**2)
-            data_cache['wind_speed'] = data_cache['wind_speed'].assign_coords(latitude=data_cache['u10'].latitude, longitude=data_cache['u10'].longitude)
+            # One float32 pass written over u10, which nothing reads afterwards
+            u10, v10 = data_cache.pop('u10'), data_cache.pop('v10')
+            wind_speed(u10, v10, u10)
+            data_cache['wind_speed'] = u10
 
         if not data_cache:
             return True
 
-        # 2. Generate Maps with Cartopy
+        # Display units, converted in place on each whole field once rather than on a copy per region
+        for var_key in {var_key for _, var_key, _ in tasks}:
+            key = VAR_CONFIG[var_key]['key']
+            if key in data_cache:
+                VAR_CONFIG[var_key]['unit_conv'](data_cache[key])
+
+        # 2. Generate Maps: all of a region's variables go through the renderer together
+        by_region = {}
+        for reg_name, var_key, out_filename in tasks:
+            if VAR_CONFIG[var_key]['key'] in data_cache:
+                by_region.setdefault(reg_name, []).append((var_key, out_filename))
+
         generated_count = 0
-        for reg_name, reg_cfg in REGIONS.items():
-            if fhr_int > reg_cfg['max_fhr']: continue
-            
-            lon_min, lon_max, lat_min, lat_max = reg_cfg['extent']
-
-            for var_key, config in VAR_CONFIG.items():
-                out_filename = f"aigfs_{reg_name}_{date_str}_{run}_{fhr_str}_{var_key}.png"
-                out_path = os.path.join(output_dir, out_filename)
-                json_path = out_path.replace('.png', '.json')
-
-                if not REPROCESS and os.path.exists(out_path):
-                    continue
-                if config['key'] not in data_cache:
-                    continue
-                if config['key'] == 'wind_speed' and 'wind_speed' not in data_cache:
-                    continue
-
-                raw_data = data_cache[config['key']]
-                data = config['unit_conv'](raw_data)
-
-                # Loose crop to speed up plotting (add buffer)
-                data_crop = data.sel(latitude=slice(lat_min - 2, lat_max + 2), longitude=slice(lon_min - 2, lon_max + 2))
-                if data_crop.size == 0: continue
-
-                # Stats Calculation
-                valid_vals = data_crop.values[~np.isnan(data_crop.values)]
-                if len(valid_vals) > 0:
-                    min_val, max_val = float(np.min(valid_vals)), float(np.max(valid_vals))
-                else:
-                    min_val, max_val = 0.0, 0.0
-
-                # PLOTTING
-                # Figure setup: We want high-res output
-                # Calculate precise aspect ratio to prevent whitespace
-                proj = ccrs.Mercator.GOOGLE
-                # We need to compute the extent in projected coordinates to get aspect ratio
-                # transform points
-                # SouthWest
-                p0 = proj.transform_point(lon_min, lat_min, ccrs.PlateCarree())
-                # NorthEast
-                p1 = proj.transform_point(lon_max, lat_max, ccrs.PlateCarree())
-                
-                # Aspect Ratio = Width / Height
-                aspect = (p1[0] - p0[0]) / (p1[1] - p0[1])
-                
-                # Base width 10 inches -> Height = 10 / aspect
-                # DPI 100 -> Width 1000px
-                fig = plt.figure(figsize=(10, 10 / aspect), dpi=100)
-                
-                # Create axes filling the entire figure (0,0,1,1)
-                ax = plt.axes([0, 0, 1, 1], projection=proj)
-                
-                # Set Extent
-                ax.set_extent([lon_min, lon_max, lat_min, lat_max], crs=ccrs.PlateCarree())
-                
-                # Colormap setup
-                cmap = config['cmap']
-                if isinstance(cmap, str): cmap = plt.get_cmap(cmap)
-                norm = mcolors.BoundaryNorm(config['levels'], ncolors=cmap.N, extend='both')
-
-                # Plot Data
-                # transform=ccrs.PlateCarree() tells Cartopy the data is Lat/Lon
-                mesh = ax.pcolormesh(data_crop.longitude, data_crop.latitude, data_crop.values, 
-                                     transform=ccrs.PlateCarree(),
-                                     cmap=cmap, norm=norm, shading='auto')
-
-                # Hide Axes/Borders completely
-                ax.axis('off')
-                
-                # Special handling for Precip (Alpha)
-                if var_key == 'tp':
-                    # Masked array:
-                    masked_data = np.ma.masked_less(data_crop.values, 0.01)
-                    ax.clear() # Clear the previous unmasked plot
-                    ax.axis('off')
-                    ax.set_extent([lon_min, lon_max, lat_min, lat_max], crs=ccrs.PlateCarree())
-                    mesh = ax.pcolormesh(data_crop.longitude, data_crop.latitude, masked_data,
-                                        transform=ccrs.PlateCarree(),
-                                        cmap=cmap, norm=norm, shading='auto')
-                else:
-                     # Global transparency for other layers
-                     mesh.set_alpha(0.7)
-
-                # Save with no padding
-                plt.savefig(out_path, transparent=True, dpi=100)
-                plt.close(fig)
-                
-                # Save Stats
-                with open(json_path, 'w') as jf:
-                    json.dump({'min': min_val, 'max': max_val, 'unit': config['unit_label']}, jf)
-
-                generated_count += 1
+        for reg_name, reg_tasks in by_region.items():
+            # Loose crop to speed up plotting (add buffer)
+            rows, cols, weights = region_grid(reg_name, lat, lon)
+            if weights is None: continue
+
+            var_keys, fields, stats, out_paths = [], [], [], []
+            for var_key, out_filename in reg_tasks:
+                values = data_cache[VAR_CONFIG[var_key]['key']][rows, cols]
+                var_keys.append(var_key)
+                fields.append(values)
+                stats.append(field_stats(values, VAR_CONFIG[var_key]['unit_label']))
+                out_paths.append(os.path.join(output_dir, out_filename))
+
+            # Save Stats first: a map counts as done once its PNG exists, so its JSON must already be there
+            for out_path, var_stats in zip(out_paths, stats):
+                write_stats(var_stats, out_path.replace('.png', '.json'))
+
+            # Direct raster: bilinear sample -> bin -> palette index, no figure or reprojection pass
+            render_region(fields, weights, var_keys, out_paths)
+
+            generated_count += len(out_paths)
         
         del data_cache
-        gc.collect()
         if generated_count > 0:
             print(f"Processed {basename}: Generated {generated_count} maps")
         return True
@@ -283,48 +625,182 @@ def process_file(file_path):
         
         return False
 
+def init_worker():
+    """
+    Runs once in each pool worker before its first file: builds the region frames and compiles
+    the render kernels, so that cost is not charged to whichever map comes first.
+    (No numba disk cache: it records the importing module's name, so entries written via
+    run_all.py's 'backend.processor' break the service, which runs this file as __main__.)
+    """
+    for reg_name in REGIONS:
+        region_frame(reg_name)
+    # Same argument types as a real region: one float32 crop view per variable (contiguous for
+    # full-width crops like global, strided otherwise), intp/float32 weights, uint8 bins
+    idx, frac = np.zeros(1, dtype=np.intp), np.zeros(1, dtype=np.float32)
+    levels, nlevels = stacked_levels(list(VAR_CONFIG))
+    for crop in (np.zeros((2, 2), dtype=np.float32), np.zeros((3, 3), dtype=np.float32)[:2, :2]):
+        fields = tuple(crop for _ in VAR_CONFIG)
+        render_bins(fields, idx, frac, idx, frac, levels, nlevels, np.empty((len(fields), 1, 1), dtype=np.uint8))
+    z = np.zeros((2, 2), dtype=np.float32)
+    wind_speed(z, z, z)
+
+def _legend_font():
+    try:
+        return ImageFont.load_default(size=LEGEND_FONT_SIZE)
+    except TypeError:  # Pillow < 10.1 only has the fixed-size bitmap font
+        return ImageFont.load_default()
+
+def draw_legend(config, out_path):
+    """
+    Horizontal colorbar drawn straight from a variable's palette LUT: one equal-width cell
+    per level interval, pointed ends for the below/above-range bins, white tick labels.
+    """
+    palette, levels = config['palette_u8'], config['levels_arr']
+    ticks = levels[::2] if len(levels) > 15 else levels
+    font = _legend_font()
+
+    end_w = LEGEND_BAR_HEIGHT // 2
+    x0, x1 = end_w + 2, LEGEND_WIDTH - end_w - 3
+    top, bottom = 2, 2 + LEGEND_BAR_HEIGHT
+    mid = (top + bottom) / 2
+    cell = (x1 - x0) / (len(levels) - 1)
+    line_h = font.getbbox('0123456789')[3] + 4
+    img = Image.new('RGBA', (LEGEND_WIDTH, bottom + 6 + 2 * line_h + 4), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+
+    # Same colors as the maps, but opaque; bins the maps leave transparent stay empty here too
+    color = lambda k: tuple(int(c) for c in palette[k, :3]) + ((255,) if palette[k, 3] else (0,))
+    for k in range(1, len(levels)):
+        draw.rectangle([round(x0 + (k - 1) * cell), top, round(x0 + k * cell), bottom], fill=color(k))
+    draw.polygon([(x0, top), (x0 - end_w, mid), (x0, bottom)], fill=color(0), outline='black')
+    draw.polygon([(x1, top), (x1 + end_w, mid), (x1, bottom)], fill=color(len(levels)), outline='black')
+    draw.rectangle([x0, top, x1, bottom], outline='black')
+
+    # Every tick gets a mark; labels that would run into the previous one are skipped
+    last_right = -LEGEND_WIDTH
+    for t in ticks:
+        x = round(x0 + np.searchsorted(levels, t) * cell)
+        draw.line([(x, bottom), (x, bottom + 4)], fill='white')
+        label = f"{t:g}"
+        w = draw.textlength(label, font=font)
+        left = min(max(x - w / 2, 0), LEGEND_WIDTH - w)  # End labels are nudged inside the image
+        if left > last_right + 4:
+            draw.text((left, bottom + 6), label, fill='white', font=font)
+            last_right = left + w
+    unit_w = draw.textlength(config['unit_label'], font=font)
+    draw.text(((LEGEND_WIDTH - unit_w) / 2, bottom + 6 + line_h), config['unit_label'], fill='white', font=font)
+    img.save(out_path, 'PNG')
+
 def generate_legends(output_dir):
     print("--- Generating Color Legends ---")
     for var_key, config in VAR_CONFIG.items():
-        out_path = os.path.join(output_dir, f"legend_{var_key}.png")
-        fig, ax = plt.subplots(figsize=(4, 0.8))
-        fig.subplots_adjust(bottom=0.5)
-        cmap = config['cmap']
-        if isinstance(cmap, str): cmap = plt.get_cmap(cmap)
-        norm = mcolors.BoundaryNorm(config['levels'], ncolors=cmap.N, extend='both')
-        cb = plt.colorbar(plt.cm.ScalarMappable(norm=norm, cmap=cmap), cax=ax, orientation='horizontal',
-                         ticks=config['levels'][::2] if len(config['levels']) > 15 else config['levels'], label=f"{config['unit_label']}")
-        cb.ax.tick_params(labelsize=8, colors='white')
-        cb.set_label(config['unit_label'], color='white', size=9)
-        plt.savefig(out_path, transparent=True, bbox_inches='tight', dpi=150)
-        plt.close(fig)
+        draw_legend(config, os.path.join(output_dir, f"legend_{var_key}.png"))
+
+class GribWatcher:
+    """
+    inotify watch on the data tree that reports GRIBs as they are completed.
+    The scraper renames finished downloads into place (MOVED_TO); CLOSE_WRITE covers direct writes.
+    """
+    def __init__(self, data_dir):
+        self.inotify = INotify()
+        self.mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        self.dirs = {}  # watch descriptor -> directory path
+        self._watch_tree(data_dir)
+
+    def _watch_tree(self, root):
+        """Watches root and every directory below it. Returns the GRIBs already inside them."""
+        gribs, stack = [], [root]
+        while stack:
+            path = stack.pop()
+            try:
+                self.dirs[self.inotify.add_watch(path, self.mask)] = path
+                with os.scandir(path) as it:
+                    for de in it:
+                        if de.is_dir(follow_symlinks=False): stack.append(de.path)
+                        elif de.name.endswith('.grib2'): gribs.append(de.path)
+            except OSError:
+                continue  # Removed before we got to it
+        return gribs
+
+    def wait(self, timeout_s):
+        """Blocks up to timeout_s for completed GRIBs, coalescing a burst over EVENT_BATCH_S."""
+        gribs = []
+        for ev in self.inotify.read(timeout=int(timeout_s * 1000), read_delay=int(EVENT_BATCH_S * 1000)):
+            if ev.mask & flags.IGNORED:
+                self.dirs.pop(ev.wd, None)  # Directory was deleted (e.g. an old run cleaned up)
+                continue
+            parent = self.dirs.get(ev.wd)
+            if parent is None or not ev.name:
+                continue
+            path = os.path.join(parent, ev.name)
+            if ev.mask & flags.ISDIR:
+                if ev.mask & (flags.CREATE | flags.MOVED_TO):
+                    # New run directory: files can land before the watch exists, so list it too
+                    gribs.extend(self._watch_tree(path))
+            elif ev.name.endswith('.grib2') and ev.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                gribs.append(path)
+        return sorted(set(gribs))
 
 def run_processor_service():
-    print(f"--- AIGFS Raster Processor (Cartopy) Started ({MAX_WORKERS} Workers) ---")
+    print(f"--- AIGFS Raster Processor Started ({MAX_WORKERS} Workers) ---")
     data_dir, output_dir = "data", os.path.join("static", "maps")
     os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(data_dir, exist_ok=True)
     generate_legends(output_dir)
+    if removed := remove_partial_maps(output_dir):
+        print(f"Removed {removed} partial maps; they will be rendered again")
 
-    while True:
-        files_to_process = []
-        for root, dirs, files in os.walk(data_dir):
-            for f in sorted(files):
-                if f.endswith('.grib2'):
-                    files_to_process.append(os.path.join(root, f))
-        
-        if files_to_process:
-            print(f"\n[Parallel Cycle] Scanning {len(files_to_process)} files...")
-            with Pool(MAX_WORKERS) as pool:
-                pool.map(process_file, files_to_process)
+    # With inotify, cycles are driven by file arrivals plus a periodic full scan; without it, plain polling
+    watcher = GribWatcher(data_dir) if INotify is not None else None
+    next_scan, new_gribs = 0.0, []
+
+    # Workers stay alive across cycles so imports and worker setup are paid once per service start
+    pool = ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=init_worker)
+    try:
+        while True:
+            if watcher is None or time.monotonic() >= next_scan:
+                files_to_process, stale_indexes = scan_data_dir(data_dir)
+                next_scan = time.monotonic() + HEARTBEAT_S
+            else:
+                files_to_process, stale_indexes = new_gribs, []
+
+            # One listing of the output dir per cycle; fully rendered files never reach the pool
+            jobs = pending_jobs(files_to_process, existing_outputs(output_dir)) if files_to_process else []
+            if jobs and not ram_ok():
+                # Gate the whole cycle here rather than having every worker fail its check
+                print(f"Low RAM: deferring {len(jobs)} files to the next cycle")
+                # Deferred files will not be announced again, so the next cycle rescans
+                next_scan = min(next_scan, time.monotonic() + POLL_INTERVAL_S)
+            elif jobs:
+                print(f"\n[Parallel Cycle] Processing {len(jobs)} of {len(files_to_process)} files...")
+                threads = kernel_threads(len(jobs))
+                futures = [pool.submit(process_file, path, tasks, threads) for path, tasks in jobs]
+                for future in as_completed(futures):
+                    err = future.exception()
+                    if isinstance(err, BrokenProcessPool):
+                        # A worker died (e.g. OOM-killed) and took the pool with it: every other
+                        # future fails the same way, so rebuild once and rescan for what was lost
+                        print(f"Worker pool broke ({err}); restarting it")
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        pool = ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=init_worker)
+                        next_scan = min(next_scan, time.monotonic() + POLL_INTERVAL_S)
+                        break
+                    if err is not None:
+                        print(f"Worker error: {err!r}")
         
-        for root, dirs, files in os.walk(data_dir):
-            for f in files:
-                if f.endswith('.idx') and not os.path.exists(os.path.join(root, f.replace('.idx', ''))):
-                    try: os.remove(os.path.join(root, f))
-                    except: pass
+            # Clear cfgrib indexes left behind by GRIBs that have since been deleted
+            for idx_path in stale_indexes:
+                try: os.remove(idx_path)
+                except: pass
         
-        print("Cycle complete. Sleeping...")
-        time.sleep(60)
+            if watcher is None:
+                print("Cycle complete. Sleeping...")
+                time.sleep(POLL_INTERVAL_S)
+            else:
+                print("Cycle complete. Waiting for new GRIB files...")
+                new_gribs = watcher.wait(max(0.0, next_scan - time.monotonic()))
+    finally:
+        pool.shutdown()
 
 if __name__ == "__main__":
     run_processor_service()
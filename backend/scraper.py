@@ -1,44 +1,109 @@
 import os
 import requests
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def download_aigfs_data(date_str, run, forecast_hours):
+# Concurrent downloads per run. Kept small: NOMADS blocks clients that hammer it.
+DOWNLOAD_THREADS = 4
+# Files this size or smaller are treated as failed downloads and fetched again
+MIN_COMPLETE_BYTES = 1000
+# Published forecast hours, f000-f384 every 6 h
+FORECAST_HOURS = tuple(f"{h:03d}" for h in range(0, 390, 6))
+
+def make_session():
     """
-    Downloads AIGFS GRIB2 files from NOAA NOMADS.
+    One keep-alive session for all NOMADS requests, so files reuse pooled TCP/TLS connections.
+    Read errors and 5xx responses are retried with backoff; a 404 (not yet published) is not.
+    A failed connect is retried only once, so an unreachable host fails fast instead of backing off.
     """
+    session = requests.Session()
+    retry = Retry(total=3, connect=1, backoff_factor=2, status_forcelist=(500, 502, 503, 504),
+                  allowed_methods=('GET',))
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=DOWNLOAD_THREADS, max_retries=retry))
+    return session
+
+def _download_file(session, url, target_path):
+    filename = os.path.basename(target_path)
+    print(f"Downloading {url}...")
+    try:
+        with session.get(url, stream=True, timeout=30) as response:
+            if response.status_code == 404:
+                print(f"File not yet available: {filename}")
+                return False
+            response.raise_for_status()
+            temp_path = target_path + ".tmp"
+            with open(temp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+        os.rename(temp_path, target_path)
+        print(f"Saved to {target_path}")
+        return True
+    except Exception as e:
+        print(f"Failed to download {filename}: {e}")
+        return False
+
+def _pending_downloads(date_str, run, forecast_hours):
+    """(url, target path) for each file of a run that is not complete on disk yet."""
     base_url = f"https://nomads.ncep.noaa.gov/pub/data/nccf/com/aigfs/prod/aigfs.{date_str}/{run}/model/atmos/grib2/"
     download_dir = os.path.join("data", f"{date_str}_{run}")
     os.makedirs(download_dir, exist_ok=True)
 
-    downloaded_any = False
+    pending = []
     for fhr in forecast_hours:
         filename = f"aigfs.t{run}z.sfc.f{fhr}.grib2"
-        url = base_url + filename
         target_path = os.path.join(download_dir, filename)
 
+        # Complete files are skipped locally, without any request to NOMADS
         if os.path.exists(target_path):
-            if os.path.getsize(target_path) > 1000:
+            if os.path.getsize(target_path) > MIN_COMPLETE_BYTES:
                 continue
+        pending.append((base_url + filename, target_path))
+    return pending
 
-        print(f"Downloading {url}...")
-        try:
-            response = requests.get(url, stream=True, timeout=30)
-            if response.status_code == 404:
-                print(f"File not yet available: {filename}")
-                continue
-            response.raise_for_status()
-            temp_path = target_path + ".tmp"
-            with open(temp_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            os.rename(temp_path, target_path)
-            print(f"Saved to {target_path}")
-            downloaded_any = True
-        except Exception as e:
-            print(f"Failed to download {filename}: {e}")
-    
-    return downloaded_any
+def _download_all(pending, session, on_file):
+    def fetch(job):
+        saved = _download_file(session, *job)
+        if saved and on_file is not None:
+            on_file(job[1])
+        return saved
+
+    owns_session = session is None
+    if owns_session:
+        session = make_session()
+    try:
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS) as pool:
+            results = list(pool.map(fetch, pending))
+    finally:
+        if owns_session:
+            session.close()
+    return any(results)
+
+def download_aigfs_data(date_str, run, forecast_hours, session=None, on_file=None):
+    """
+    Downloads AIGFS GRIB2 files from NOAA NOMADS.
+    Missing files are fetched DOWNLOAD_THREADS at a time over one pooled session.
+    on_file, if given, is called with each file's path as soon as it is saved.
+    """
+    pending = _pending_downloads(date_str, run, forecast_hours)
+    if not pending:
+        return False
+    return _download_all(pending, session, on_file)
+
+def download_runs(runs, forecast_hours, session=None, on_file=None):
+    """
+    Like download_aigfs_data, for several (date, run) pairs at once.
+    All missing files share one DOWNLOAD_THREADS pool, so a slow file in one run does not
+    hold up the next run's downloads. Runs are fetched in the order given.
+    """
+    pending = []
+    for date_str, run in runs:
+        pending.extend(_pending_downloads(date_str, run, forecast_hours))
+    if not pending:
+        return False
+    return _download_all(pending, session, on_file)
 
 def get_latest_runs():
     """
@@ -61,15 +126,14 @@ def run_scraper_service():
     Infinite loop that checks for new AIGFS runs every hour.
     """
     print("--- AIGFS Downloader Service Started ---")
-    forecast_hours = [f"{h:03d}" for h in range(0, 390, 6)]
+    session = make_session()
 
     while True:
         latest_runs = get_latest_runs()
         print(f"\n[Run Check] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         
-        for date_str, run_str in latest_runs:
-            print(f" Checking {date_str} {run_str}Z...")
-            download_aigfs_data(date_str, run_str, forecast_hours)
+        print(f" Checking {len(latest_runs)} runs...")
+        download_runs(latest_runs, FORECAST_HOURS, session=session)
         
         # Sleep for 60 minutes before checking again
         print("Scraper sleeping for 60 minutes...")
@@ -1,13 +1,16 @@
 """NWS API client for fetching Alta Collins station (CLN) observations."""
 
 import os
+import copy
+import sys
 import logging
+from abc import ABC, abstractmethod
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+import asyncio
 import httpx
 from dotenv import load_dotenv
 import time
-from functools import wraps
 
 load_dotenv()
 
@@ -23,28 +26,120 @@ NWS_USER_AGENT = os.getenv(
 # However, if 'CLN' works in the original code, we keep it. If not, we might need a fallback.
 # Actually, let's stick to the user's provided ID default, but ensure fallback.
 STATION_ID = os.getenv('STATION_ID', 'CLN') 
+# Station observations update at most hourly; reuse the latest one for this many seconds
+try:
+    CACHE_TTL = int(os.getenv('NWS_CACHE_TTL', '300'))
+except ValueError:
+    CACHE_TTL = 300
+
+# HTTP/2 needs the optional 'h2' package (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+# orjson decodes large observation pages several times faster than the stdlib
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+# ijson parses a response incrementally, for pulls too large to hold decoded all at once
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 logger = logging.getLogger(__name__)
 
-# Simple retry decorator to replace the missing dependency
-def retry_on_failure(max_retries=3, delay=1.0, exceptions=(Exception,)):
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            last_exception = None
-            for i in range(max_retries):
-                try:
-                    return func(*args, **kwargs)
-                except exceptions as e:
-                    last_exception = e
-                    time.sleep(delay * (2 ** i)) # Exponential backoff
-            logger.error(f"Function {func.__name__} failed after {max_retries} retries: {last_exception}")
-            return None
-        return wrapper
-    return decorator
+# station_id -> (monotonic fetch time, parsed latest observation), shared by all fetchers
+_LATEST_CACHE: Dict[str, Tuple[float, Dict]] = {}
 
-class NWSObservationFetcher:
-    """Fetcher for NWS observation data."""
+# NWS API fields mapped to our (variable name, unit)
+_VAR_MAP = (
+    ('temperature', 'temperature', 'celsius'),
+    ('dewpoint', 'dewpoint', 'celsius'),
+    ('windDirection', 'wind_direction', 'degrees'),
+    ('windSpeed', 'wind_speed', 'm/s'),
+    ('windGust', 'wind_gust', 'm/s'),
+    ('barometricPressure', 'pressure', 'Pa'),
+    ('seaLevelPressure', 'sea_level_pressure', 'Pa'),
+    ('visibility', 'visibility', 'm'),
+    ('precipitationLastHour', 'precipitation_1h', 'mm'),
+    ('precipitationLast3Hours', 'precipitation_3h', 'mm'),
+    ('precipitationLast6Hours', 'precipitation_6h', 'mm'),
+    ('relativeHumidity', 'relative_humidity', 'percent'),
+    ('windChill', 'wind_chill', 'celsius'),
+    ('heatIndex', 'heat_index', 'celsius'),
+    ('maxTemperatureLast24Hours', 'temperature_max_24h', 'celsius'),
+    ('minTemperatureLast24Hours', 'temperature_min_24h', 'celsius'),
+)
+
+# fromisoformat is C-implemented and accepts a trailing 'Z' from Python 3.11 on,
+# which beats slicing the fields out by hand; older versions need the rewrite
+if sys.version_info >= (3, 11):
+    _parse_nws_ts = datetime.fromisoformat
+else:
+    def _parse_nws_ts(s: str) -> datetime:
+        return datetime.fromisoformat(s.replace('Z', '+00:00'))
+
+# Connection failures are retried by the transport; these statuses are retried in _make_request
+MAX_RETRIES = 3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_DELAY = 1.0
+MAX_RETRY_AFTER = 60.0  # Upper bound on a server-requested Retry-After wait, in seconds
+
+
+_UTC_FMT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def _to_utc_str(dt: datetime) -> str:
+    """Format as YYYY-MM-DDThh:mm:ssZ; naive datetimes are taken to already be UTC."""
+    if dt.tzinfo is None:
+        return dt.strftime(_UTC_FMT)
+    return dt.astimezone(timezone.utc).strftime(_UTC_FMT)
+
+
+class _ByteStream:
+    """Minimal file-like view of an httpx byte iterator, as ijson reads with read()."""
+    
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+    
+    def read(self, size: int = -1) -> bytes:
+        if size == 0:
+            return b''  # ijson probes with read(0) to tell bytes from str
+        return next(self._chunks, b'')
+
+
+class _AsyncByteStream:
+    """Async counterpart of _ByteStream; ijson switches to async parsing for an async read()."""
+    
+    def __init__(self, chunks: AsyncIterator[bytes]):
+        self._chunks = chunks
+    
+    async def read(self, size: int = -1) -> bytes:
+        if size == 0:
+            return b''
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b''
+
+
+def _retry_delay(response: httpx.Response, attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying a failed response, or None if it should not be retried."""
+    if response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+        return None
+    retry_after = response.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        return min(float(retry_after), MAX_RETRY_AFTER)
+    return RETRY_DELAY * (2 ** attempt)  # Exponential backoff
+
+
+class _NWSObservationBase(ABC):
+    """Station settings, request parameters and response parsing shared by both fetchers."""
     
     def __init__(self):
         self.base_url = NWS_API_BASE_URL
@@ -53,83 +148,54 @@ class NWSObservationFetcher:
             'User-Agent': NWS_USER_AGENT,
             'Accept': 'application/json'
         }
+        # One pooled client so back-to-back requests reuse the keep-alive connection
+        self._client = self._build_client()
+        # Parse failures warn once per page; tracebacks only at DEBUG
+        self._parse_warned = False
     
-    def _make_request(self, endpoint: str) -> Optional[Dict]:
-        """Make HTTP request to NWS API."""
-        url = f"{self.base_url}{endpoint}"
-        
-        try:
-            with httpx.Client(timeout=30.0) as client:
-                response = client.get(url, headers=self.headers)
-                response.raise_for_status()
-                return response.json()
-        except httpx.HTTPError as e:
-            logger.error(f"HTTP error fetching {url}: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"Error fetching {url}: {e}", exc_info=True)
-            return None
+    @abstractmethod
+    def _build_client(self):
+        """Return the pooled httpx client (sync or async) the subclass sends requests through."""
     
-    @retry_on_failure(max_retries=3, delay=1.0, exceptions=(Exception,))
-    def get_latest_observation(self) -> Optional[Dict]:
-        """
-        Get the latest observation from CLN station.
-        
-        Returns:
-            Dictionary with observation data or None
-        """
-        endpoint = f"/stations/{self.station_id}/observations/latest"
-        data = self._make_request(endpoint)
-        
-        if not data:
-            return None
-        
-        return self._parse_observation(data)
+    def _cached_latest(self) -> Optional[Dict]:
+        entry = _LATEST_CACHE.get(self.station_id)
+        if entry and time.monotonic() - entry[0] < CACHE_TTL:
+            # Copies both ways, so a caller editing its observation can't change the cached one
+            return copy.deepcopy(entry[1])
+        return None
     
-    def get_observations(
+    def _store_latest(self, obs: Optional[Dict]) -> Optional[Dict]:
+        if obs:
+            _LATEST_CACHE[self.station_id] = (time.monotonic(), copy.deepcopy(obs))
+        return obs
+    
+    def _parse_latest(self, data: Dict) -> Optional[Dict]:
+        # A single observation per call, so a failure here always warns
+        self._parse_warned = False
+        return self._store_latest(self._parse_observation(data))
+    
+    def _observations_params(
         self,
-        start_time: Optional[datetime] = None,
-        end_time: Optional[datetime] = None,
-        limit: int = 500
-    ) -> List[Dict]:
-        """
-        Get historical observations from CLN station.
-        
-        Args:
-            start_time: Start time for observations
-            end_time: End time for observations
-            limit: Maximum number of observations to return
-            
-        Returns:
-            List of observation dictionaries
-        """
-        endpoint = f"/stations/{self.station_id}/observations"
+        start_time: Optional[datetime],
+        end_time: Optional[datetime],
+        limit: int
+    ) -> Dict:
+        """Build the /observations query parameters for a time window."""
         params = {'limit': limit}
         
         if start_time:
-            # Convert to UTC and format as YYYY-MM-DDThh:mm:ssZ
-            if start_time.tzinfo is None:
-                start_time = start_time.replace(tzinfo=timezone.utc)
-            else:
-                start_time = start_time.astimezone(timezone.utc)
-            params['start'] = start_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+            params['start'] = _to_utc_str(start_time)
         if end_time:
-            # Convert to UTC and format as YYYY-MM-DDThh:mm:ssZ
-            if end_time.tzinfo is None:
-                end_time = end_time.replace(tzinfo=timezone.utc)
-            else:
-                end_time = end_time.astimezone(timezone.utc)
-            params['end'] = end_time.strftime('%Y-%m-%dT%H:%M:%SZ')
-        
-        # Build URL with query parameters
-        query_string = '&'.join([f"{k}={v}" for k, v in params.items()])
-        endpoint = f"{endpoint}?{query_string}"
-        
-        data = self._make_request(endpoint)
+            params['end'] = _to_utc_str(end_time)
         
+        return params
+    
+    def _parse_features(self, data: Optional[Dict]) -> List[Dict]:
+        """Parse every feature of an /observations response."""
         if not data or 'features' not in data:
             return []
         
+        self._parse_warned = False
         observations = []
         for feature in data['features']:
             obs = self._parse_observation(feature)
@@ -162,62 +228,169 @@ class NWSObservationFetcher:
             if not timestamp_str:
                 return None
             
-            timestamp = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
+            timestamp = _parse_nws_ts(timestamp_str)
             
             # Extract observation values
-            observation_data = {
-                'station_id': self.station_id,
-                'timestamp': timestamp,
-                'variables': {}
-            }
-            
-            # Map NWS API fields to our variable names
-            variable_mapping = {
-                'temperature': ('temperature', 'celsius'),
-                'dewpoint': ('dewpoint', 'celsius'),
-                'windDirection': ('wind_direction', 'degrees'),
-                'windSpeed': ('wind_speed', 'm/s'),
-                'windGust': ('wind_gust', 'm/s'),
-                'barometricPressure': ('pressure', 'Pa'),
-                'seaLevelPressure': ('sea_level_pressure', 'Pa'),
-                'visibility': ('visibility', 'm'),
-                'precipitationLastHour': ('precipitation_1h', 'mm'),
-                'precipitationLast3Hours': ('precipitation_3h', 'mm'),
-                'precipitationLast6Hours': ('precipitation_6h', 'mm'),
-                'relativeHumidity': ('relative_humidity', 'percent'),
-                'windChill': ('wind_chill', 'celsius'),
-                'heatIndex': ('heat_index', 'celsius'),
-                'maxTemperatureLast24Hours': ('temperature_max_24h', 'celsius'),
-                'minTemperatureLast24Hours': ('temperature_min_24h', 'celsius'),
-            }
-            
-            for nws_field, (var_name, unit) in variable_mapping.items():
-                value_obj = props.get(nws_field)
-                if value_obj and 'value' in value_obj:
-                    value = value_obj['value']
-                    quality_flag = value_obj.get('qualityControl', None)
-                    
-                    if value is not None:
-                        observation_data['variables'][var_name] = {
-                            'value': float(value),
-                            'unit': unit,
-                            'quality_flag': quality_flag
-                        }
+            variables = {}
+            get = props.get
+            for nws_field, var_name, unit in _VAR_MAP:
+                value_obj = get(nws_field)
+                if value_obj and (value := value_obj.get('value')) is not None:
+                    variables[var_name] = {
+                        'value': float(value),
+                        'unit': unit,
+                        'quality_flag': value_obj.get('qualityControl')
+                    }
             
             # Handle cloud layers if present
             cloud_layers = props.get('cloudLayers', [])
             if cloud_layers:
-                observation_data['variables']['cloud_cover'] = {
+                variables['cloud_cover'] = {
                     'value': len(cloud_layers),
                     'unit': 'layers',
                     'layers': cloud_layers
                 }
             
-            return observation_data
+            return {
+                'station_id': self.station_id,
+                'timestamp': timestamp,
+                'variables': variables
+            }
             
         except Exception as e:
-            logger.error(f"Error parsing observation: {e}", exc_info=True)
+            # A malformed page can fail on every feature: don't format a traceback for each one
+            if not self._parse_warned:
+                logger.warning(f"Error parsing observation (further failures logged at DEBUG): {e}")
+                self._parse_warned = True
+            logger.debug("Error parsing observation", exc_info=True)
+            return None
+
+
+class NWSObservationFetcher(_NWSObservationBase):
+    """Fetcher for NWS observation data."""
+    
+    def _build_client(self) -> httpx.Client:
+        # Pool limits and HTTP/2 are transport settings once a transport is passed in
+        transport = httpx.HTTPTransport(
+            retries=MAX_RETRIES,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            http2=HTTP2
+        )
+        return httpx.Client(
+            base_url=self.base_url,
+            headers=self.headers,
+            timeout=30.0,
+            transport=transport
+        )
+    
+    def close(self):
+        """Close the underlying HTTP client."""
+        self._client.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def _make_request(self, endpoint: str, params: Optional[Dict] = None) -> Optional[Dict]:
+        """Make HTTP request to NWS API."""
+        url = f"{self.base_url}{endpoint}"
+        
+        try:
+            for attempt in range(MAX_RETRIES + 1):
+                response = self._client.get(endpoint, params=params)
+                delay = _retry_delay(response, attempt)
+                if delay is None:
+                    break
+                time.sleep(delay)
+            response.raise_for_status()
+            return _loads(response.content)
+        except httpx.HTTPError as e:
+            logger.error(f"HTTP error fetching {url}: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Error fetching {url}: {e}", exc_info=True)
+            return None
+    
+    def get_latest_observation(self) -> Optional[Dict]:
+        """
+        Get the latest observation from CLN station.
+        
+        Returns:
+            Dictionary with observation data or None
+        """
+        cached = self._cached_latest()
+        if cached:
+            return cached
+        
+        endpoint = f"/stations/{self.station_id}/observations/latest"
+        data = self._make_request(endpoint)
+        
+        if not data:
             return None
+        
+        return self._parse_latest(data)
+    
+    def get_observations(
+        self,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        limit: int = 500
+    ) -> List[Dict]:
+        """
+        Get historical observations from CLN station.
+        
+        Args:
+            start_time: Start time for observations
+            end_time: End time for observations
+            limit: Maximum number of observations to return
+            
+        Returns:
+            List of observation dictionaries
+        """
+        endpoint = f"/stations/{self.station_id}/observations"
+        params = self._observations_params(start_time, end_time, limit)
+        return self._parse_features(self._make_request(endpoint, params))
+    
+    def iter_observations(
+        self,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        limit: int = 500
+    ) -> Iterator[Dict]:
+        """
+        Yield historical observations one at a time while the response streams in.
+        
+        Peak memory stays at one feature instead of the whole decoded page, at the cost of
+        a slower parse than get_observations(). Without ijson this falls back to it.
+        """
+        if ijson is None:
+            yield from self.get_observations(start_time, end_time, limit)
+            return
+        
+        endpoint = f"/stations/{self.station_id}/observations"
+        params = self._observations_params(start_time, end_time, limit)
+        url = f"{self.base_url}{endpoint}"
+        self._parse_warned = False
+        
+        try:
+            for attempt in range(MAX_RETRIES + 1):
+                with self._client.stream('GET', endpoint, params=params) as response:
+                    delay = _retry_delay(response, attempt)
+                    if delay is None:
+                        response.raise_for_status()
+                        features = ijson.items(_ByteStream(response.iter_bytes()), 'features.item', use_float=True)
+                        for feature in features:
+                            obs = self._parse_observation(feature)
+                            if obs:
+                                yield obs
+                        return
+                time.sleep(delay)
+        except httpx.HTTPError as e:
+            logger.error(f"HTTP error fetching {url}: {e}")
+        except Exception as e:
+            logger.error(f"Error fetching {url}: {e}", exc_info=True)
     
     def get_station_info(self) -> Optional[Dict]:
         """Get metadata about the CLN station."""
@@ -240,10 +413,155 @@ class NWSObservationFetcher:
         return self.get_observations(start_time=start_time, end_time=end_time)
 
 
+class AsyncNWSObservationFetcher(_NWSObservationBase):
+    """Async fetcher that requests several observation windows concurrently."""
+    
+    def _build_client(self) -> httpx.AsyncClient:
+        transport = httpx.AsyncHTTPTransport(
+            retries=MAX_RETRIES,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+            http2=HTTP2
+        )
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=self.headers,
+            timeout=30.0,
+            transport=transport
+        )
+    
+    async def close(self):
+        """Close the underlying HTTP client."""
+        await self._client.aclose()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc):
+        await self.close()
+    
+    async def _make_request(self, endpoint: str, params: Optional[Dict] = None) -> Optional[Dict]:
+        """Make HTTP request to NWS API."""
+        url = f"{self.base_url}{endpoint}"
+        
+        try:
+            for attempt in range(MAX_RETRIES + 1):
+                response = await self._client.get(endpoint, params=params)
+                delay = _retry_delay(response, attempt)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+            response.raise_for_status()
+            return _loads(response.content)
+        except httpx.HTTPError as e:
+            logger.error(f"HTTP error fetching {url}: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Error fetching {url}: {e}", exc_info=True)
+            return None
+    
+    async def get_latest_observation(self) -> Optional[Dict]:
+        """Get the latest observation from CLN station."""
+        cached = self._cached_latest()
+        if cached:
+            return cached
+        
+        endpoint = f"/stations/{self.station_id}/observations/latest"
+        data = await self._make_request(endpoint)
+        
+        if not data:
+            return None
+        
+        return self._parse_latest(data)
+    
+    async def get_observations(
+        self,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        limit: int = 500
+    ) -> List[Dict]:
+        """Get historical observations from CLN station."""
+        endpoint = f"/stations/{self.station_id}/observations"
+        params = self._observations_params(start_time, end_time, limit)
+        return self._parse_features(await self._make_request(endpoint, params))
+    
+    async def iter_observations(
+        self,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        limit: int = 500
+    ) -> AsyncIterator[Dict]:
+        """Async counterpart of NWSObservationFetcher.iter_observations()."""
+        if ijson is None:
+            for obs in await self.get_observations(start_time, end_time, limit):
+                yield obs
+            return
+        
+        endpoint = f"/stations/{self.station_id}/observations"
+        params = self._observations_params(start_time, end_time, limit)
+        url = f"{self.base_url}{endpoint}"
+        self._parse_warned = False
+        
+        try:
+            for attempt in range(MAX_RETRIES + 1):
+                async with self._client.stream('GET', endpoint, params=params) as response:
+                    delay = _retry_delay(response, attempt)
+                    if delay is None:
+                        response.raise_for_status()
+                        features = ijson.items(_AsyncByteStream(response.aiter_bytes()), 'features.item', use_float=True)
+                        async for feature in features:
+                            obs = self._parse_observation(feature)
+                            if obs:
+                                yield obs
+                        return
+                await asyncio.sleep(delay)
+        except httpx.HTTPError as e:
+            logger.error(f"HTTP error fetching {url}: {e}")
+        except Exception as e:
+            logger.error(f"Error fetching {url}: {e}", exc_info=True)
+    
+    async def get_observations_batch(
+        self,
+        windows: List[Tuple[datetime, datetime]],
+        limit: int = 500
+    ) -> List[Dict]:
+        """
+        Get observations for several time windows at once.
+        
+        Args:
+            windows: (start_time, end_time) pairs
+            limit: Maximum number of observations per window
+            
+        Returns:
+            List of observation dictionaries, in window order
+        """
+        endpoint = f"/stations/{self.station_id}/observations"
+        pages = await asyncio.gather(*[
+            self._make_request(endpoint, self._observations_params(start, end, limit))
+            for start, end in windows
+        ])
+        
+        observations = []
+        for data in pages:
+            observations.extend(self._parse_features(data))
+        return observations
+    
+    async def get_station_info(self) -> Optional[Dict]:
+        """Get metadata about the CLN station."""
+        endpoint = f"/stations/{self.station_id}"
+        return await self._make_request(endpoint)
+    
+    async def get_recent_observations(self, hours: int = 24) -> List[Dict]:
+        """Get observations from the last N hours."""
+        end_time = datetime.utcnow()
+        start_time = end_time - timedelta(hours=hours)
+        
+        return await self.get_observations(start_time=start_time, end_time=end_time)
+
+
 def fetch_latest_observation() -> Optional[Dict]:
     """Convenience function to fetch latest observation."""
-    fetcher = NWSObservationFetcher()
-    return fetcher.get_latest_observation()
+    with NWSObservationFetcher() as fetcher:
+        return fetcher.get_latest_observation()
 
 
 def fetch_observations(
@@ -252,6 +570,32 @@ def fetch_observations(
     limit: int = 500
 ) -> List[Dict]:
     """Convenience function to fetch observations."""
-    fetcher = NWSObservationFetcher()
-    return fetcher.get_observations(start_time, end_time, limit)
+    with NWSObservationFetcher() as fetcher:
+        return fetcher.get_observations(start_time, end_time, limit)
+
+
+async def fetch_latest_observation_async() -> Optional[Dict]:
+    """Convenience coroutine to fetch latest observation."""
+    async with AsyncNWSObservationFetcher() as fetcher:
+        return await fetcher.get_latest_observation()
+
+
+async def fetch_observations_async(
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    limit: int = 500
+) -> List[Dict]:
+    """Convenience coroutine to fetch observations."""
+    async with AsyncNWSObservationFetcher() as fetcher:
+        return await fetcher.get_observations(start_time, end_time, limit)
 
+
+def fetch_observations_batch(
+    windows: List[Tuple[datetime, datetime]],
+    limit: int = 500
+) -> List[Dict]:
+    """Convenience function to fetch several observation windows concurrently."""
+    async def _run():
+        async with AsyncNWSObservationFetcher() as fetcher:
+            return await fetcher.get_observations_batch(windows, limit)
+    return asyncio.run(_run())
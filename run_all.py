@@ -1,39 +1,126 @@
 import os
-import sys
-from backend.scraper import download_aigfs_data, get_latest_runs
-from backend.processor import process_grib_file
-
-def main():
-    forecast_hours = [f"{h:03d}" for h in range(0, 390, 6)]
-    latest_runs = get_latest_runs()
-    
-    print(f"--- Checking for new AIGFS runs ---")
-    
-    total_processed = 0
-    for date_str, run_str in latest_runs:
-        print(f"\n[Run Check] {date_str} {run_str}Z")
-        
-        # 1. Download
-        downloaded = download_aigfs_data(date_str, run_str, forecast_hours)
-        
-        # 2. Process
+import queue
+import argparse
+import threading
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from backend.scraper import download_runs, get_latest_runs, FORECAST_HOURS, MIN_COMPLETE_BYTES
+from backend.processor import process_file, pending_jobs, existing_outputs, remove_partial_maps, kernel_threads, MAX_WORKERS, init_worker
+
+def entry_size(entry):
+    """Size of a scandir entry, or 0 if it was deleted since the listing (the processor removes corrupt GRIBs)."""
+    try:
+        return entry.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+def run_pipeline(runs, forecast_hours):
+    """
+    Downloads and renders the given (date, run) pairs.
+    Returns the number of GRIB files handed to the processor.
+    """
+    output_dir = os.path.join("static", "maps")
+    os.makedirs(output_dir, exist_ok=True)
+    if removed := remove_partial_maps(output_dir):
+        print(f"  Removed {removed} partial maps; they will be rendered again")
+
+    # 1. Complete files already on disk, listed before any download starts. Files the downloader
+    #    will fetch again (too small to be complete) are left to arrive through the queue, so no
+    #    path is queued twice.
+    grib_paths = []
+    for date_str, run_str in runs:
         data_dir = os.path.join("data", f"{date_str}_{run_str}")
-        output_dir = os.path.join("static", "maps")
-        os.makedirs(output_dir, exist_ok=True)
-        
-        if os.path.exists(data_dir):
-            files = [f for f in os.listdir(data_dir) if f.endswith('.grib2')]
-            if not files:
-                print(f"  No GRIB2 files found in {data_dir}")
-                continue
-                
-            print(f"  Found {len(files)} files to process in {data_dir}")
-            for f in sorted(files):
-                grib_path = os.path.join(data_dir, f)
-                process_grib_file(grib_path, output_dir, date_str=date_str)
-                total_processed += 1
-        else:
-            print(f"  Data directory {data_dir} does not exist.")
+        wanted = {f"aigfs.t{run_str}z.sfc.f{fhr}.grib2" for fhr in forecast_hours}
+        try:
+            with os.scandir(data_dir) as it:
+                entries = sorted((e for e in it if e.name in wanted and entry_size(e) > MIN_COMPLETE_BYTES),
+                                 key=lambda e: e.name)
+        except FileNotFoundError:
+            continue
+        print(f"  Found {len(entries)} existing files in {data_dir}")
+        grib_paths.extend(e.path for e in entries)
+
+    # Files whose maps are all rendered already are dropped here; the rest carry their missing maps
+    jobs = pending_jobs(grib_paths, existing_outputs(output_dir))
+    if len(jobs) < len(grib_paths):
+        print(f"  Skipping {len(grib_paths) - len(jobs)} files with all maps already rendered")
+
+    # 2. Download in a background thread; each saved file is queued for processing on arrival,
+    #    so rendering overlaps the network instead of waiting for every run to finish downloading
+    arrivals = queue.Queue()
+
+    def download():
+        try:
+            print(f"\n[Run Check] {len(runs)} runs")
+            download_runs(runs, forecast_hours, on_file=arrivals.put)
+        finally:
+            arrivals.put(None)  # Sentinel: no more files
+
+    downloader = threading.Thread(target=download, daemon=True)
+    downloader.start()
+
+    # 3. Process: files are independent and CPU-bound, so render them across worker processes.
+    #    Workers come from a forkserver, not fork: they start on demand while the download threads
+    #    hold stdout/SSL/connection-pool locks, which a forked child would inherit locked.
+    total_processed = 0
+    mp_context = multiprocessing.get_context('forkserver')
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=init_worker, mp_context=mp_context) as pool:
+        # Each file's kernels get the cores' share for the files in flight when it is submitted:
+        # downloads usually trickle in one at a time, and a lone file should use every core
+        threads = kernel_threads(len(jobs))
+        futures = [pool.submit(process_file, path, tasks, threads) for path, tasks in jobs]
+        while (path := arrivals.get()) is not None:
+            in_flight = sum(not f.done() for f in futures) + 1
+            futures.append(pool.submit(process_file, path, None, kernel_threads(in_flight)))
+        downloader.join()
+
+        for future in as_completed(futures):
+            future.result()
+            total_processed += 1
+    return total_processed
+
+def run_date(value):
+    """argparse type for --date: a real calendar date written as YYYYMMDD."""
+    try:
+        parsed = datetime.strptime(value, "%Y%m%d")
+    except ValueError:
+        parsed = None
+    # strptime also takes short fields ('2026013' -> 2026-01-03); the value goes into NOMADS
+    # URLs and data/ paths as given, so it must be the canonical 8-digit form
+    if parsed is None or parsed.strftime("%Y%m%d") != value:
+        raise argparse.ArgumentTypeError(f"expected a date as YYYYMMDD, got {value!r}")
+    return value
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Download and render AIGFS runs.")
+    parser.add_argument('--date', type=run_date, help="Run date as YYYYMMDD (requires --run)")
+    parser.add_argument('--run', choices=('00', '06', '12', '18'), help="Run hour (requires --date)")
+    parser.add_argument('--latest', action='store_true',
+                        help="Check the recent runs from get_latest_runs() (the default without --date/--run)")
+    parser.add_argument('--fh-step', type=int, default=6,
+                        help="Forecast-hour step; a multiple of 6 (default: 6, every published hour)")
+    args = parser.parse_args(argv)
+    if (args.date is None) != (args.run is None):
+        parser.error("--date and --run must be given together")
+    if args.latest and args.date:
+        parser.error("--latest cannot be combined with --date/--run")
+    if args.fh_step <= 0 or args.fh_step % 6:
+        parser.error("--fh-step must be a positive multiple of 6")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    forecast_hours = FORECAST_HOURS[::args.fh_step // 6]
+
+    if args.date:
+        runs = [(args.date, args.run)]
+        print(f"--- Processing AIGFS run {runs[0][0]} {runs[0][1]}Z ---")
+    else:
+        runs = get_latest_runs()
+        print(f"--- Checking for new AIGFS runs ---")
+
+    total_processed = run_pipeline(runs, forecast_hours)
 
     print(f"\n--- Processing Finished. Total files handled: {total_processed} ---")
     print(f"Check your 'static/maps' folder for .png files.")